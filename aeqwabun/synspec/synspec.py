@@ -1,26 +1,74 @@
+import ctypes
 import functools
+import itertools
+import mmap
+import os
 import shutil
+import string
 import subprocess
+import sys
 import tempfile
-from contextlib import _GeneratorContextManager, contextmanager
-from pathlib import Path
-from typing import Callable, Iterator
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager, contextmanager
+from pathlib import Path, PurePath
+from typing import Any, Iterable, Iterator, Literal, Sequence
 
 from aeqwabun.synspec import units, utils
 
+# synspec output units and the extensions they are extracted to
+OUTUNITS = {
+    "7": "spec",
+    "12": "iden",
+    "16": "eqws",
+    "17": "cont",
+    "log": "log",
+}
+
+# lockfile guarding run directories
+LOCKFN = "synspec.lock"
+
+# input files at least this large are read through mmap
+MMAP_THRESHOLD = 64 * 1024
+
+# memory backed directories tried for temporary run directories with ramdisk=True
+RAMDISKS = ("/dev/shm", "/tmp")
+# free space a ramdisk needs to be used
+RAMDISK_MIN_FREE = 256 * 1024 * 1024
+
 
 class Synspec:
-    def __init__(self, synspecpath: str = "synspec", version: int = 51):
+    def __init__(
+        self, synspecpath: str = "synspec", version: int = 51, ramdisk: bool = False
+    ):
+        """Wraps the synspec executable at synspecpath.
+        ramdisk: place temporary run directories on a memory backed
+                 filesystem when one is available.
+        """
         if version != 51:
             raise NotImplementedError("Only version 51 is supported")
         self.version = version
         self.synspec = synspecpath
+        self.ramdisk = ramdisk
         self.linkfiles: dict[str, str | Path] = {  # default links
             "fort.19": "fort.19",
             "fort.55": "fort.55",
             "{model}.5": "{modelpath}.5",
             "{model}.7": "{modelpath}.7",
         }
+        self._persistent_rundir: Path | None = None
+        # Guards linkfiles, which run() may extend while other runs read it.
+        self._linklock = threading.Lock()
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Locks can't be pickled; each copy gets a fresh one.
+        state = self.__dict__.copy()
+        del state["_linklock"]
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._linklock = threading.Lock()
 
     def add_link(self, linkfrom: str, linkto: str = None) -> None:
         """Adds a link from the given file to the given file."""
@@ -34,6 +82,8 @@ class Synspec:
         rundir: str | Path | None = ".",
         outdir: str | Path | None = None,
         outfile: str | None = None,
+        reuse: bool = False,
+        capture_log: bool | Literal["inherit"] = True,
     ) -> None:
         """Runs synspec with the given model.
         rundir: directory to run synspec in.
@@ -41,88 +91,192 @@ class Synspec:
                 if explicitly set to None, a temporary directory is used.
         outdir: directory to copy the output files to.
         outfile: name (without extension) of the output files.
+        reuse: keep links to model independent files in rundir which already
+               point to the right file. Implied for the directory of
+               persistent_rundir.
+        capture_log: if True, synspec's output is saved to {outfile}.log.
+                     if False, it is discarded.
+                     if "inherit", it goes to the standard output of this process.
         """
-        modelpath = Path(model).resolve()
+        if capture_log not in (True, False, "inherit"):
+            raise ValueError(
+                f'capture_log must be True, False or "inherit", not {capture_log!r}'
+            )
+        _realpath.cache_clear()
+        modelpath = _resolve(model)
         model = modelpath.name
+        usetemp = rundir is None
         if rundir is None:
             if outdir is None:
                 outdir = Path.cwd()
-            rdprovider: Callable[[], _GeneratorContextManager[Path]] = tempdir
-        else:
-            rundir = Path(rundir).resolve()
-            rundir.mkdir(exist_ok=True)
-            rdprovider = functools.partial(
-                utils.folderlock, path=rundir, lockfn="synspec.lock"
+            rdcontext: AbstractContextManager[Path] = (
+                tempdir(prefer=RAMDISKS, min_free=RAMDISK_MIN_FREE)
+                if self.ramdisk
+                else tempdir()
             )
+        else:
+            rundir = _resolve(rundir)
+            if rundir == self._persistent_rundir:
+                # Already locked by persistent_rundir.
+                reuse = True
+                rdcontext = _keeplock(rundir, LOCKFN)
+            else:
+                rundir.mkdir(exist_ok=True)
+                rdcontext = utils.folderlock(path=rundir, lockfn=LOCKFN)
 
         if outdir is None:
             outdir = rundir
-        outdir = Path(outdir).resolve()
+        outdir = _resolve(outdir)
 
         if outfile is None:
             outfile = model
 
-        with rdprovider() as rundir:
-            self._remove_potential_outfiles(model, outdir, outfile)
-            self._copy_to_rundir(model, modelpath, rundir)
+        with rdcontext as rundir:
+            self._remove_potential_outfiles(
+                model, outdir, outfile, log=capture_log is not True
+            )
+            with self._linklock:
+                self._copy_to_rundir(model, modelpath, rundir, reuse=reuse)
             self._check_files(model, rundir)
-            self._run(model, rundir)
-            self._extract_outfiles(model, rundir, outdir, outfile)
+            self._run(model, rundir, capture_log)
+            self._extract_outfiles(
+                model, rundir, outdir, outfile, move=usetemp, log=capture_log is True
+            )
 
-    def _run(self, model: str, rundir: Path) -> None:
+    def run_many(
+        self, models: Iterable[str], max_workers: int | None = None, **kwargs: Any
+    ) -> None:
+        """Runs synspec concurrently for each of the given models.
+        Each model is run in its own temporary directory.
+        max_workers: maximum number of simultaneous synspec processes.
+                     defaults to, and is capped at, the number of CPUs.
+        Other keyword arguments are passed on to run.
+        """
+        if kwargs.get("rundir") is not None or "outfile" in kwargs:
+            raise ValueError("run_many does not accept rundir or outfile")
+        kwargs["rundir"] = None
+        models = list(models)
+        names = [Path(model).name for model in models]
+        if len(set(names)) != len(names):
+            # Outputs are named after the model and would overwrite each other.
+            raise ValueError("run_many needs models with distinct names")
+        ncpu = os.cpu_count() or 1
+        max_workers = min(max_workers or ncpu, ncpu, max(len(models), 1))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.run, model, **kwargs) for model in models]
+        for future in futures:
+            future.result()
+
+    @contextmanager
+    def persistent_rundir(self, path: str | Path) -> Iterator[Path]:
+        """Context manager which locks a run directory for successive runs.
+        Model independent files are linked once, and calls to run with this
+        directory as rundir only update the model specific links.
+        """
+        _realpath.cache_clear()
+        rundir = _resolve(path)
+        rundir.mkdir(exist_ok=True)
+        with utils.folderlock(path=rundir, lockfn=LOCKFN) as rundir:
+            self._link_static(rundir)
+            self._persistent_rundir = rundir
+            try:
+                yield rundir
+            finally:
+                self._persistent_rundir = None
+
+    def _run(
+        self, model: str, rundir: Path, capture_log: bool | Literal["inherit"] = True
+    ) -> None:
         utils.symlinkf(f"{model}.7", rundir / "fort.8")
-        with open(rundir / f"{model}.5") as modelinput, open(
-            rundir / "fort.log", "w"
-        ) as log:
-            subprocess.run(
-                [self.synspec], stdin=modelinput, stdout=log, cwd=rundir, check=True
-            )
+        # Outputs of a previous run may be hardlinked into outdir; make sure
+        # synspec writes fresh files rather than overwriting them in place.
+        for unit in OUTUNITS:
+            (rundir / f"fort.{unit}").unlink(missing_ok=True)
+        # Both ends are regular files, so hand the child raw OS descriptors
+        # rather than Python file objects or pipes.
+        infd = os.open(rundir / f"{model}.5", os.O_RDONLY)
+        try:
+            logfd: int | None = None
+            stdout: int | None
+            if capture_log == "inherit":
+                stdout = None  # inherits our stdout
+            elif capture_log:
+                stdout = logfd = os.open(
+                    rundir / "fort.log", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644
+                )
+            else:
+                stdout = subprocess.DEVNULL
+            try:
+                subprocess.run(
+                    [self.synspec], stdin=infd, stdout=stdout, cwd=rundir, check=True
+                )
+            finally:
+                if logfd is not None:
+                    os.close(logfd)
+        finally:
+            os.close(infd)
 
     def _extract_outfiles(
-        self, model: str, rundir: Path, outdir: Path, outfile: str | None
+        self,
+        model: str,
+        rundir: Path,
+        outdir: Path,
+        outfile: str | None,
+        move: bool = False,
+        log: bool = True,
     ) -> None:
+        """Copies the output files from rundir to outdir.
+        On the same filesystem the files are hardlinked (or renamed if move is
+        True) instead of copied. The log is skipped if log is False.
+        """
         outdir.mkdir(exist_ok=True)
 
-        for unit, ext in [
-            ("7", "spec"),
-            ("12", "iden"),
-            ("16", "eqws"),
-            ("17", "cont"),
-        ]:
-            shutil.copyfile(rundir / f"fort.{unit}", outdir / f"{outfile}.{ext}")
-        shutil.copyfile(rundir / "fort.log", outdir / f"{outfile}.log")
+        jobs = [
+            (rundir / f"fort.{unit}", outdir / f"{outfile}.{ext}")
+            for unit, ext in OUTUNITS.items()
+            if log or unit != "log"
+        ]
+        if rundir.stat().st_dev == outdir.stat().st_dev:
+            # Links are cheap metadata operations, not worth a thread pool.
+            for src, dst in jobs:
+                _linkfile(src, dst, move=move)
+        else:
+            # The copies are independent and I/O bound, so let them overlap.
+            with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                list(executor.map(_copyfile, *zip(*jobs)))
 
     def _remove_potential_outfiles(
-        self, model: str, outdir: Path, outfile: str | None
+        self, model: str, outdir: Path, outfile: str | None, log: bool = False
     ) -> None:
-        if not outdir.is_dir():
+        """Deletes output files of an earlier run from outdir.
+        The log is only deleted if log is True, i.e. when this run won't
+        replace it.
+        """
+        exts = ["spec", "iden", "eqws", "cont"] + (["log"] if log else [])
+        names = {f"{outfile}.{ext}" for ext in exts}
+        try:
+            with os.scandir(outdir) as entries:
+                stale = [e.path for e in entries if e.name in names and e.is_file()]
+        except (FileNotFoundError, NotADirectoryError):
             return
-        for ext in ["spec", "iden", "eqws", "cont"]:
-            f = outdir / f"{outfile}.{ext}"
-            print(f"Should delete {f}")
-            if f.is_file():
-                f.unlink()
+        for f in stale:
+            os.unlink(f)
 
-    def _copy_to_rundir(self, model: str, modelpath: Path, rundir: Path) -> None:
+    def _copy_to_rundir(
+        self, model: str, modelpath: Path, rundir: Path, reuse: bool = False
+    ) -> None:
+        fmt = {"model": model, "modelpath": modelpath}
         # Read the input file to see if extra links are required.
-        inputfile = str(self.linkfiles["{model}.5"]).format(
-            model=model, modelpath=modelpath
-        )
-        with open(inputfile) as f:
-            modelinput = units.readinput(f.read())
-        reqs = []
-        if modelinput.get("finstd"):
-            reqs.append(modelinput["finstd"])
-        if "ions" in modelinput:
-            for ion in modelinput["ions"]:
-                reqs.append(ion["filei"])
-        reqs = list(
-            {
-                str(x).split("/", maxsplit=1)[0]
-                for x in map(Path, reqs)
-                if not x.is_absolute()
-            }
-        )
+        inputfile = str(self.linkfiles["{model}.5"]).format(**fmt)
+        modelinput = _readinputf(os.path.abspath(inputfile), _filestamp(inputfile))
+        reqs: set[str] = set()
+        for item in itertools.chain(
+            [modelinput["finstd"]] if modelinput.get("finstd") else [],
+            (ion["filei"] for ion in modelinput.get("ions", [])),
+        ):
+            path = PurePath(item)
+            if path.parts and not path.is_absolute():
+                reqs.add(path.parts[0])
 
         for req in reqs:
             if Path(req).exists() and req not in self.linkfiles:
@@ -131,7 +285,7 @@ class Synspec:
         # Detect need for fort.56
         if "fort.56" not in self.linkfiles:
             cofigfile = Path(str(self.linkfiles["fort.55"]).format(model=model))
-            config = units.read55f(cofigfile)
+            config = _read55f(os.path.abspath(cofigfile), _filestamp(cofigfile))
             if config.ichemc != 0:
                 if Path("fort.56").is_file():
                     self.linkfiles["fort.56"] = "fort.56"
@@ -139,16 +293,32 @@ class Synspec:
                     raise FileNotFoundError("Need for fort.56 detected but not found")
 
         # Link the required files to the run directory.
+        self._link_static(rundir, reuse=reuse)
+        self._link_per_model(model, modelpath, rundir)
+
+    def _link_static(self, rundir: Path, reuse: bool = False) -> None:
+        """Links the files which do not depend on the model.
+        If reuse is True, links in rundir which already point to src are kept.
+        """
+        links = []
         for dst, src in self.linkfiles.items():
-            src = Path(str(src).format(model=model, modelpath=modelpath)).resolve()
-            if (
-                rundir != Path.cwd().resolve()
-                or src
-                != Path(str(dst).format(model=model, modelpath=modelpath)).resolve()
-            ):
-                utils.symlinkf(
-                    src, rundir / dst.format(model=model, modelpath=modelpath)
-                )
+            cdst, csrc = _constant(dst), _constant(str(src))
+            if cdst is None or csrc is None:
+                continue
+            if reuse and _links_to(rundir / cdst, csrc):
+                continue
+            links.append((cdst, csrc))
+        _link_files(links, rundir)
+
+    def _link_per_model(self, model: str, modelpath: Path, rundir: Path) -> None:
+        """Links the files whose names depend on the model."""
+        fmt = {"model": model, "modelpath": modelpath}
+        links = [
+            (dst.format(**fmt), str(src).format(**fmt))
+            for dst, src in self.linkfiles.items()
+            if _constant(dst) is None or _constant(str(src)) is None
+        ]
+        _link_files(links, rundir)
 
     def _check_files(self, model: str, rundir: Path) -> None:
         """Checks if the required files exist."""
@@ -158,8 +328,133 @@ class Synspec:
                 raise FileNotFoundError(f"{fn} not found")
 
 
+@functools.lru_cache(maxsize=256)
+def _realpath(path: str) -> str:
+    return os.path.realpath(path)
+
+
+def _resolve(path: str | os.PathLike[str]) -> Path:
+    """Cached equivalent of Path(path).resolve().
+    The cache is cleared on every call to Synspec.run and persistent_rundir.
+    """
+    return Path(_realpath(os.path.abspath(path)))
+
+
+@functools.lru_cache(maxsize=None)
+def _constant(template: str) -> str | None:
+    """Returns the formatted template if it has no replacement fields, so that
+    it is independent of the model being run, and None otherwise.
+    """
+    parts = list(string.Formatter().parse(template))
+    if any(field is not None for _, field, _, _ in parts):
+        return None
+    return "".join(literal for literal, _, _, _ in parts)
+
+
+def _links_to(link: Path, src: str) -> bool:
+    """Whether link is a symlink to the resolved src."""
+    try:
+        return os.readlink(link) == os.fspath(_resolve(src))
+    except OSError:
+        return False
+
+
+def _link_files(links: list[tuple[str, str]], rundir: Path) -> None:
+    """Symlinks each (dst, src) pair into rundir, skipping files which would
+    link to themselves."""
+    incwd = rundir == _resolve(os.getcwd())
+    for dst, src in links:
+        srcpath = _resolve(src)
+        if not incwd or srcpath != _resolve(dst):
+            utils.symlinkf(srcpath, rundir / dst)
+
+
+def _filestamp(path: str | os.PathLike[str]) -> tuple[int, int, int]:
+    """Modification time, inode and size of a file, identifying its version."""
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_ino, st.st_size
+
+
+@functools.lru_cache(maxsize=32)
+def _read55f(path: str, stamp: tuple[int, int, int]) -> units.SynConfig:
+    """Reads a .55 file.
+    stamp (see _filestamp) is only part of the cache key, so modified files
+    are re-read. path should be absolute.
+    """
+    return units.read55f(Path(path))
+
+
+@functools.lru_cache(maxsize=32)
+def _readinputf(path: str, stamp: tuple[int, int, int]) -> dict[str, Any]:
+    """Reads and parses a synspec input file.
+    stamp (see _filestamp) is only part of the cache key, so modified files
+    are re-read. path should be absolute.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            return units.readinput(f.read().decode())
+        # Decode straight from the mapped pages, skipping the bytes copy.
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return units.readinput(str(mm, "utf-8"))
+
+
+def _linkfile(src: Path, dst: Path, move: bool = False) -> None:
+    """Hardlinks (or renames if move is True) src to dst, replacing dst.
+    Falls back to copying if the filesystem does not support it.
+    """
+    try:
+        if move:
+            os.replace(src, dst)
+        else:
+            dst.unlink(missing_ok=True)
+            os.link(src, dst)
+    except OSError:
+        _copyfile(src, dst)
+
+
+def _copyfile(src: Path, dst: Path) -> None:
+    """Copies src to dst.
+    shutil.copyfile already uses sendfile/fcopyfile on Linux and macOS; on
+    Windows the copy is handed to CopyFileW instead of a userspace loop.
+    """
+    if sys.platform == "win32":
+        if not ctypes.windll.kernel32.CopyFileW(str(src), str(dst), False):
+            raise ctypes.WinError()
+    else:
+        shutil.copyfile(src, dst)
+
+
 @contextmanager
-def tempdir() -> Iterator[Path]:
-    """Context manager for temporary directories."""
-    with tempfile.TemporaryDirectory() as tmpdir:
+def _keeplock(path: Path, lockfn: str) -> Iterator[Path]:
+    """Context manager for a folder this process has already locked.
+    Refreshes the lockfile on entry and on exit so that it does not expire
+    between runs.
+    """
+    lockfile = path / lockfn
+    os.utime(lockfile)
+    yield path
+    os.utime(lockfile)
+
+
+@contextmanager
+def tempdir(prefer: Sequence[str] = (), min_free: int = 0) -> Iterator[Path]:
+    """Context manager for temporary directories.
+    prefer: directories to create the temporary directory in. The first one
+            which is writable and has at least min_free bytes available is
+            used, otherwise the default temporary directory.
+    """
+    with tempfile.TemporaryDirectory(dir=_pick_dir(prefer, min_free)) as tmpdir:
         yield Path(tmpdir).resolve()
+
+
+def _pick_dir(candidates: Sequence[str], min_free: int = 0) -> str | None:
+    for candidate in candidates:
+        try:
+            if (
+                os.access(candidate, os.W_OK | os.X_OK)
+                and shutil.disk_usage(candidate).free >= min_free
+            ):
+                return candidate
+        except OSError:
+            continue
+    return None
@@ -1,3 +1,4 @@
+import os
 import time
 import uuid
 from contextlib import contextmanager
@@ -130,13 +131,18 @@ elements = [
 def symlinkf(
     src: str | Path, dst: str | Path, target_is_directory: bool = False
 ) -> None:
-    """Symlink a file. If the file already exists, delete it first."""
+    """Symlink a file. If the file already exists, delete it first, unless it is
+    already a symlink to src."""
     dst = Path(dst)
     if resolve_parent(dst) == resolve_parent(Path(src)):
         raise ValueError(f"src and dst are the same: {dst.resolve()}")
-    if dst.exists():
+    try:
+        dst.symlink_to(src, target_is_directory=target_is_directory)
+    except FileExistsError:
+        if dst.is_symlink() and os.readlink(dst) == os.fspath(src):
+            return
         dst.unlink()
-    dst.symlink_to(src, target_is_directory=target_is_directory)
+        dst.symlink_to(src, target_is_directory=target_is_directory)
 
 
 def resolve_parent(path: Path) -> Path:
@@ -179,7 +185,7 @@ def folderlock(
             if the lock could not be acquired or optionally if the lcokfile
             was modified midway.
     """
-    _check_at_end = False
+    acquired = False
     if path is None:
         path = Path.cwd()
     else:
@@ -194,13 +200,14 @@ def folderlock(
             lockfile.write_text(id_)
         if lockfile.read_text() != id_:
             raise RuntimeError("Lockfile could not be acquired.")
-        _check_at_end = check_at_end
+        acquired = True
         yield path
     finally:
-        if _check_at_end:
-            if not lockfile.exists() or lockfile.read_text() != id_:
+        # Leave the lockfile alone if it belongs to someone else.
+        if acquired:
+            if check_at_end and (not lockfile.exists() or lockfile.read_text() != id_):
                 raise RuntimeError("Lockfile was modified")
-        lockfile.unlink(missing_ok=True)
+            lockfile.unlink(missing_ok=True)
 
 
 def write_to_file(file: Path | str | TextIO, content: str) -> None:
@@ -1,36 +1,75 @@
+import copy
+import errno
+import filecmp
 import os
+import pickle
 import shutil
 import subprocess
 import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Iterator
 
 import pytest
 
-from aeqwabun.synspec.synspec import Synspec
+from aeqwabun.synspec import synspec as synspec_module
+from aeqwabun.synspec import units
+from aeqwabun.synspec.synspec import (
+    MMAP_THRESHOLD,
+    Synspec,
+    _filestamp,
+    _pick_dir,
+    _readinputf,
+)
 
 PROJECT_ROOT = os.getcwd()
 MODELS_ROOT = f"{PROJECT_ROOT}/tests/models"
+PREPARED_ROOT: str | None = None  # set by the prepared_model fixture
 
 
 def compare_files(file1: str, file2: str) -> bool:
-    with open(file1, "r") as f1:
-        with open(file2, "r") as f2:
-            for line1, line2 in zip(f1, f2):
-                if line1 != line2:
-                    return False
-    return True
+    return filecmp.cmp(file1, file2, shallow=False)
 
 
 def copy_model(model: str, files: list[str], dst: str) -> str:
-    # Copy the model to the temporary directory.
+    # Hardlink the model inputs prepared for the session into the temporary
+    # directory. Tests which modify an input must replace the file rather than
+    # write into it.
     modeldir = f"{MODELS_ROOT}/{model}"
+    if PREPARED_ROOT is None:
+        inputdir = f"{modeldir}/input"
+    else:
+        inputdir = f"{PREPARED_ROOT}/{model}"
     for file in files:
-        shutil.copy(f"{modeldir}/input/{file}".format(model=model), dst)
+        src = f"{inputdir}/{file}".format(model=model)
+        try:
+            os.link(src, f"{dst}/{os.path.basename(src)}")
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM):
+                raise
+            shutil.copy(src, dst)
     os.symlink(f"{modeldir}/data", f"{dst}/data", target_is_directory=True)
     return modeldir
 
 
+@pytest.fixture(scope="session")
+def prepared_model(tmp_path_factory: pytest.TempPathFactory) -> Iterator[str]:
+    """Copies the model inputs once per session for copy_model to link from."""
+    global PREPARED_ROOT
+    root = tmp_path_factory.mktemp("models")
+    for model in os.listdir(MODELS_ROOT):
+        shutil.copytree(f"{MODELS_ROOT}/{model}/input", root / model, symlinks=True)
+    PREPARED_ROOT = str(root)
+    try:
+        yield PREPARED_ROOT
+    finally:
+        PREPARED_ROOT = None
+
+
 @pytest.fixture(scope="function")
-def tempdir():
+def tempdir(prepared_model: str):
     try:
         with tempfile.TemporaryDirectory() as tempdir:
             yield tempdir
@@ -189,6 +228,223 @@ def test_synspec_no_indir(tempdir: str) -> None:
         assert not os.path.isfile(f"{tempdir}/fort.{unit}")
 
 
+def test_synspec_ramdisk(tempdir: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    model = "hhe35lt"
+    files = ["fort.19", "fort.55", "{model}.5", "{model}.7"]
+
+    modeldir = copy_model(model, files, tempdir)
+
+    os.chdir(tempdir)
+    ramdisk = f"{tempdir}/ramdisk"
+    os.mkdir(ramdisk)
+    monkeypatch.setattr(synspec_module, "RAMDISKS", ("/nonexistent", ramdisk))
+    monkeypatch.setattr(synspec_module, "RAMDISK_MIN_FREE", 0)
+
+    # Record the run directories used.
+    rundirs = []
+    real_tempdir = synspec_module.tempdir
+
+    @contextmanager
+    def spy_tempdir(*args: Any, **kwargs: Any) -> Iterator[Path]:
+        with real_tempdir(*args, **kwargs) as path:
+            rundirs.append(path)
+            yield path
+
+    monkeypatch.setattr(synspec_module, "tempdir", spy_tempdir)
+
+    # Create a Synspec object.
+    synspec = Synspec("synspec", 51, ramdisk=True)
+    synspec.add_link("data")
+    synspec.run(model, rundir=None)
+
+    assert [path.parent for path in rundirs] == [Path(ramdisk).resolve()]
+    for ext in ["spec", "iden", "eqws", "cont"]:
+        assert compare_files(
+            f"{modeldir}/output/{model}.{ext}", f"{tempdir}/{model}.{ext}"
+        )
+
+
+def test_pick_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    small = tmp_path / "small"
+    large = tmp_path / "large"
+    missing = tmp_path / "missing"
+    small.mkdir()
+    large.mkdir()
+    free = {str(small): 10, str(large): 1000}
+    monkeypatch.setattr(
+        shutil, "disk_usage", lambda path: SimpleNamespace(free=free[str(path)])
+    )
+
+    candidates = [str(missing), str(small), str(large)]
+    assert _pick_dir(candidates, min_free=5) == str(small)
+    assert _pick_dir(candidates, min_free=100) == str(large)
+    assert _pick_dir(candidates, min_free=10000) is None
+    assert _pick_dir([str(missing)]) is None
+
+
+def test_tempdir_prefer(tmp_path: Path) -> None:
+    preferred = tmp_path / "preferred"
+    preferred.mkdir()
+    missing = tmp_path / "missing"
+
+    with synspec_module.tempdir(prefer=[str(missing), str(preferred)]) as path:
+        assert path.parent == preferred.resolve()
+    assert not path.exists()
+
+    with synspec_module.tempdir(prefer=[str(missing)]) as path:
+        assert path.parent == Path(tempfile.gettempdir()).resolve()
+
+
+def test_synspec_no_log(tempdir: str) -> None:
+    model = "hhe35lt"
+    files = ["fort.19", "fort.55", "{model}.5", "{model}.7"]
+
+    modeldir = copy_model(model, files, tempdir)
+
+    os.chdir(tempdir)
+    with open(f"{model}.log", "w") as f:
+        f.write("stale log of an earlier run\n")
+
+    # Create a Synspec object.
+    synspec = Synspec("synspec", 51)
+    synspec.add_link("data")
+    synspec.run(model, rundir=None, capture_log=False)
+
+    assert compare_files(f"{modeldir}/output/{model}.spec", f"{tempdir}/{model}.spec")
+    assert not os.path.isfile(f"{tempdir}/{model}.log")
+
+
+def test_synspec_inherit_log(tempdir: str) -> None:
+    model = "hhe35lt"
+    files = ["fort.19", "fort.55", "{model}.5", "{model}.7"]
+
+    modeldir = copy_model(model, files, tempdir)
+
+    os.chdir(tempdir)
+    with open(f"{model}.log", "w") as f:
+        f.write("stale log of an earlier run\n")
+
+    # Create a Synspec object.
+    synspec = Synspec("synspec", 51)
+    synspec.run(model, capture_log="inherit")
+
+    assert compare_files(f"{modeldir}/output/{model}.spec", f"{tempdir}/{model}.spec")
+    assert not os.path.isfile(f"{tempdir}/{model}.log")
+    assert not os.path.isfile(f"{tempdir}/fort.log")
+
+
+def test_synspec_invalid_capture_log() -> None:
+    synspec = Synspec("synspec", 51)
+    with pytest.raises(ValueError):
+        synspec.run("hhe35lt", capture_log="yes")  # type: ignore
+
+
+def test_synspec_persistent_rundir(tempdir: str) -> None:
+    model = "hhe35lt"
+    files = ["fort.19", "fort.55", "{model}.5", "{model}.7"]
+
+    modeldir = copy_model(model, files, tempdir)
+
+    os.chdir(tempdir)
+    rundir = f"{tempdir}/run"
+    outdir = f"{tempdir}/output"
+
+    # Create a Synspec object.
+    synspec = Synspec("synspec", 51)
+    synspec.add_link("data")
+    with synspec.persistent_rundir(rundir):
+        assert os.path.islink(f"{rundir}/fort.19")
+        for outfile in ["first", "second"]:
+            synspec.run(model, rundir=rundir, outdir=outdir, outfile=outfile)
+            assert compare_files(
+                f"{modeldir}/output/{model}.spec", f"{outdir}/{outfile}.spec"
+            )
+    assert not os.path.exists(f"{rundir}/synspec.lock")
+
+
+def test_synspec_persistent_rundir_relink(tempdir: str) -> None:
+    """Links changed between runs in a persistent rundir must be updated."""
+    model = "hhe35lt"
+    files = ["fort.19", "fort.55", "{model}.5", "{model}.7"]
+
+    modeldir = copy_model(model, files, tempdir)
+
+    os.chdir(tempdir)
+    rundir = f"{tempdir}/run"
+    shutil.copy("fort.19", "linelist")
+
+    # Create a Synspec object.
+    synspec = Synspec("synspec", 51)
+    synspec.add_link("data")
+    with synspec.persistent_rundir(rundir):
+        synspec.run(model, rundir=rundir)
+        assert os.readlink(f"{rundir}/fort.19") == os.path.realpath("fort.19")
+
+        synspec.add_link("linelist", "fort.19")
+        synspec.run(model, rundir=rundir)
+        assert os.readlink(f"{rundir}/fort.19") == os.path.realpath("linelist")
+    assert compare_files(f"{modeldir}/output/{model}.spec", f"{rundir}/{model}.spec")
+
+
+def test_synspec_persistent_rundir_keeps_lock(tempdir: str) -> None:
+    """The lock of a persistent rundir must not expire between runs."""
+    model = "hhe35lt"
+    files = ["fort.19", "fort.55", "{model}.5", "{model}.7"]
+
+    modeldir = copy_model(model, files, tempdir)
+
+    os.chdir(tempdir)
+    rundir = f"{tempdir}/run"
+    lockfile = f"{rundir}/synspec.lock"
+
+    # Create a Synspec object.
+    synspec = Synspec("synspec", 51)
+    synspec.add_link("data")
+    with synspec.persistent_rundir(rundir):
+        aged = time.time() - 120
+        os.utime(lockfile, (aged, aged))
+        synspec.run(model, rundir=rundir)
+
+        other = Synspec("synspec", 51)
+        other.add_link("data")
+        with pytest.raises(RuntimeError):
+            other.run(model, rundir=rundir)
+        assert os.path.isfile(lockfile)
+
+        synspec.run(model, rundir=rundir)
+    assert compare_files(f"{modeldir}/output/{model}.spec", f"{rundir}/{model}.spec")
+    assert not os.path.exists(lockfile)
+
+
+def test_synspec_run_many(tempdir: str) -> None:
+    model = "hhe35lt"
+    models = ["first", "second", "third"]
+    files = ["fort.19", "fort.55"]
+
+    modeldir = copy_model(model, files, tempdir)
+    for name in models:
+        for ext in ["5", "7"]:
+            shutil.copy(f"{modeldir}/input/{model}.{ext}", f"{tempdir}/{name}.{ext}")
+
+    os.chdir(tempdir)
+
+    # Create a Synspec object.
+    synspec = Synspec("synspec", 51)
+    synspec.add_link("data")
+    synspec.run_many(models, max_workers=2)
+
+    for name in models:
+        assert compare_files(
+            f"{modeldir}/output/{model}.spec", f"{tempdir}/{name}.spec"
+        )
+
+
+def test_synspec_run_many_duplicate_names() -> None:
+    synspec = Synspec("synspec", 51)
+    with pytest.raises(ValueError):
+        synspec.run_many(["gridA/m1", "gridB/m1"])
+
+
 @pytest.mark.skip(reason="Not implemented yet")
 def test_synspec_simultaneous_run(tempdir: str) -> None:
     """This test should try to run two Synspec objects at the same time. The
@@ -285,6 +541,33 @@ def test_synspec_autoinclude_fort56(tempdir: str) -> None:
     compare_files(f"{modeldir}/output/{model}.spec", f"{tempdir}/fort.7")
 
 
+def test_synspec_fort55_cache_per_directory(tempdir: str) -> None:
+    """fort.55 files in different directories must not share a cache entry,
+    even with equal modification times.
+    """
+    dira = f"{tempdir}/a"
+    dirb = f"{tempdir}/b"
+    os.mkdir(dira)
+    os.mkdir(dirb)
+    copy_model("hhe35lt", ["fort.19", "fort.55", "{model}.5", "{model}.7"], dira)
+    # EHeT30g4 needs fort.56, which is left out.
+    copy_model("EHeT30g4", ["fort.19", "fort.55", "{model}.5", "{model}.7"], dirb)
+    for d in [dira, dirb]:
+        # fort.55 is hardlinked to the shared prepared copy; replace it so
+        # utime doesn't change the mtime seen by later tests.
+        shutil.copy(f"{d}/fort.55", f"{d}/fort.55.new")
+        os.replace(f"{d}/fort.55.new", f"{d}/fort.55")
+        os.utime(f"{d}/fort.55", ns=(1_000_000_000, 1_000_000_000))
+
+    # Create a Synspec object.
+    synspec = Synspec("synspec", 51)
+    os.chdir(dira)
+    synspec.run("hhe35lt")
+    os.chdir(dirb)
+    with pytest.raises(FileNotFoundError, match="fort.56"):
+        synspec.run("EHeT30g4")
+
+
 def test_synspec_autoinclude_readinput(tempdir: str) -> None:
     """Test that the Synspec object automatically includes the files detected in
     the input file ({model}.5).
@@ -414,6 +697,7 @@ def test_dont_copy_old_files_on_fail(tempdir: str) -> None:
     # Corrupt input model to make the run fail.
     with open(f"{tempdir}/{model}.7") as f:
         text = f.read()
+    os.unlink(f"{tempdir}/{model}.7")  # hardlinked, don't truncate in place
     with open(f"{tempdir}/{model}.7", "w") as f:
         f.write(text[:-20])
 
@@ -447,6 +731,7 @@ def test_delete_old_output_files_on_fail(tempdir: str) -> None:
     # Corrupt input model to make the run fail.
     with open(f"{tempdir}/{model}.7") as f:
         text = f.read()
+    os.unlink(f"{tempdir}/{model}.7")  # hardlinked, don't truncate in place
     with open(f"{tempdir}/{model}.7", "w") as f:
         f.write(text[:-20])
 
@@ -464,3 +749,26 @@ def test_delete_old_output_files_on_fail(tempdir: str) -> None:
             assert not os.path.isfile(f"{outdir}/{model}.{ext}")
     else:
         raise Exception("Process didn't fail despite faulty input files.")
+
+
+def test_synspec_pickle() -> None:
+    """Synspec objects can be sent to other processes and copied."""
+    synspec = Synspec("synspec", 51)
+    synspec.add_link("linelist", "fort.19")
+
+    clone = pickle.loads(pickle.dumps(synspec))
+    assert clone.linkfiles == synspec.linkfiles
+    assert pickle.loads(pickle.dumps(synspec.run)).__self__.synspec == "synspec"
+    assert copy.deepcopy(synspec).linkfiles == synspec.linkfiles
+
+
+def test_readinputf_mmap(tmp_path: Path) -> None:
+    """Large input files are read through mmap with the same result."""
+    text = Path(f"{MODELS_ROOT}/EHeT30g4/input/EHeT30g4.5").read_text()
+    padding = "* padding\n" * (MMAP_THRESHOLD // 10 + 1)
+    bigfile = tmp_path / "big.5"
+    bigfile.write_text(text + padding)
+    assert bigfile.stat().st_size >= MMAP_THRESHOLD
+
+    result = _readinputf(str(bigfile), _filestamp(bigfile))
+    assert result == units.readinput(text)